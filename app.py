@@ -3,12 +3,12 @@ app.py
 
 Main program that starts the Dash app locally. 
 
-If there is no saved csv file to load in DataFrame, generates one using files located in the assets folder.
+If there is no saved feather file to load in DataFrame, generates one using files located in the assets folder.
 """
 
 # Dash and Plotly imports
 import dash
-from dash import Dash, html, dcc, Input, Output
+from dash import Dash, html, dcc, Input, Output, Patch
 import plotly.express as px
 import plotly.graph_objects as go
 
@@ -31,15 +31,7 @@ import photos_util
 # this is where the photos are read from
 ASSETS_PATH = Path(os.getcwd())/'assets'
 
-# look for mapbox access token used for generating the map
-# todo: could alter so that if no mapbox, uses default plotly geomap
-if not os.path.exists(Path(os.getcwd())/'mapbox_token'):
-    print(f"No mapbox token found in {os.getcwd()}. Unable to generate map. Exiting...")
-    exit(1)
-else:
-    MAPBOX_TOKEN=open("mapbox_token").read()
 
-    
 # regions used for dropdown menu for centering map
 regions = {
     "world": {"lat": 0, "lon": 0, "zoom": 1},
@@ -54,34 +46,147 @@ regions = {
 }
 
 
+# number of photos above which the map is drawn as a single trace
+LARGE_FIGURE_SIZE = 5000
+
+
 # Dash app
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = Dash("Photo Map Viewer", external_stylesheets=external_stylesheets)
 server = app.server
 
 
+def get_mapbox_token() -> str:
+    """Returns mapbox access token used for generating the map.
+    Exits if there is no 'mapbox_token' file in the current directory."""
+    # todo: could alter so that if no mapbox, uses default plotly geomap
+    if not os.path.exists(Path(os.getcwd())/'mapbox_token'):
+        print(f"No mapbox token found in {os.getcwd()}. Unable to generate map. Exiting...")
+        exit(1)
+    with open("mapbox_token") as f:
+        return f.read()
+
+
 def get_df() -> pd.DataFrame:
-    """Returns DataFrame containing photo info"""
+    """Returns DataFrame containing photo info.
+    
+    Uses the saved DataFrame if there is one, and only reads the EXIF metadata
+    of photos in the assets folder that are not already in it.
+    """
     cur_dir = Path(os.getcwd())
-    if os.path.exists(cur_dir/'saved_df.csv'):
-        df = pd.read_csv(cur_dir/'saved_df.csv')
+    saved_path = cur_dir/'saved_df.feather'
+    skipped_path = cur_dir/'skipped_photos.txt'
+    # photos that could not be added before (e.g. missing GPS info) are not read again,
+    # unless they were modified since (e.g. geotagged later or still being copied then)
+    skipped = read_skipped_photos(skipped_path)
+    unchanged_skipped = {name for name, mtime in skipped.items() if get_mtime_ns(ASSETS_PATH/name) == mtime}
+    if os.path.exists(saved_path):
+        cached_df = pd.read_feather(saved_path)
+        if not os.path.exists(ASSETS_PATH) or (os.path.getmtime(ASSETS_PATH) <= os.path.getmtime(saved_path)
+                                               and len(unchanged_skipped) == len(skipped)
+                                               and not has_outdated_thumbnails(cached_df).any()):
+            # no photos added, removed or modified since the last save
+            return set_column_types(cached_df)
     else:
-        photo_list = photos_util.get_photos_from_path(ASSETS_PATH)
-        df = photos_util.construct_df(photo_list)
-        # make day column string based and minimize to start with 1
-        df.day = df.day - (df.day.min() - 1)
-        df.day = df.day.astype(str)
-        df.to_csv(cur_dir/'saved_df.csv', index=False)
+        cached_df = None
+
+    photo_list = photos_util.get_photos_from_path(ASSETS_PATH) or []
+    photo_names = {p.name for p in photo_list}
+    if cached_df is None:
+        known_names = set()
+    else:
+        # drop photos no longer in the assets folder and only read new ones
+        cached_df = cached_df[cached_df['filename'].isin(photo_names) & ~has_outdated_thumbnails(cached_df)]
+        known_names = set(cached_df['filename']) | unchanged_skipped
+    new_photos = [p for p in photo_list if p.name not in known_names]
+    # taken before reading, so changes made while the photos are read are noticed next time
+    new_mtimes = {p.name: get_mtime_ns(p) for p in new_photos}
+    if cached_df is None:
+        df = photos_util.construct_df(new_photos)
+    else:
+        new_df = photos_util.construct_df(new_photos) if new_photos else None
+        if new_df is not None and len(new_df):
+            df = pd.concat([cached_df, new_df], ignore_index=True)
+        else:
+            df = cached_df.reset_index(drop=True)
+    # remember photos that could not be added and their modification time
+    skipped = {name: new_mtimes.get(name, skipped.get(name)) for name in photo_names - set(df['filename'])}
+    tmp_path = skipped_path.with_name(f"{skipped_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        f.writelines(f"{mtime}\t{name}\n" for name, mtime in sorted(skipped.items()) if mtime is not None)
+    os.replace(tmp_path, skipped_path)
+    # minimize day column to start with 1
+    df['day'] = df['datetime'].dt.day
+    df.day = df.day - (df.day.min() - 1)
+    # written to a temporary file first, so other app workers never read a partly written save
+    tmp_path = saved_path.with_name(f"{saved_path.name}.{os.getpid()}.tmp")
+    df.to_feather(tmp_path)
+    os.replace(tmp_path, saved_path)
+    return set_column_types(df)
+
+
+def has_outdated_thumbnails(df: pd.DataFrame) -> pd.Series:
+    """Returns boolean Series of the rows in `df` whose thumbnail is missing: not saved,
+    no longer in the thumbnail folder, or named after the photo stem which could belong to another photo.
+    The photos of these rows are read again to save their thumbnails."""
+    thumbnail_names = photos_util.THUMBNAIL_DIR + '/' + df['filename'].astype(str) + '.jpg'
+    thumbnail_exists = df['thumbnail'].map(lambda name: isinstance(name, str) and os.path.exists(ASSETS_PATH/name))
+    return ~thumbnail_exists | (df['thumbnail'] != thumbnail_names)
+
+
+def read_skipped_photos(path: Path) -> dict:
+    """Returns dictionary of photo filenames listed in the file at `path` to the modification time
+    (in ns) the photo had when it could not be added to the DataFrame.
+    Each line is the modification time and the filename separated by a tab.
+    Returns an empty dictionary if there is no file."""
+    if not os.path.exists(path):
+        return {}
+    skipped = {}
+    with open(path) as f:
+        for line in f:
+            mtime, _, name = line.rstrip('\n').partition('\t')
+            if mtime.isdigit() and name:
+                skipped[name] = int(mtime)
+    return skipped
+
+
+def get_mtime_ns(path: Path) -> int | None:
+    """Returns modification time of the file at `path` in ns, or None if there is no file."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def set_column_types(df: pd.DataFrame) -> pd.DataFrame:
+    """Returns `df` with day as ordered categories, filename as strings
+    and coordinates rounded to 6 decimals"""
+    # day as ordered categories so they are listed by day number
+    days = df['day'].astype(int).astype(str)
+    df['day'] = pd.Categorical(days, categories=sorted(days.unique(), key=int), ordered=True)
+    df['filename'] = df['filename'].astype('string')
+    # 6 decimals (about 0.1 m) is precise enough for the map and keeps the numbers
+    # in the figure data and hover info short
+    df[['latitude', 'longitude']] = df[['latitude', 'longitude']].round(6)
     return df
 
 
 def create_figure(df: pd.DataFrame):
     """Returns mapbox figure using dataframe."""
     px.set_mapbox_access_token(MAPBOX_TOKEN)
-    fig = px.scatter_mapbox(df, lat=df.latitude, lon=df.longitude,     
-                            color="day", hover_name='datetime',
-                            hover_data=["latitude", "longitude"],
-                           zoom=1)
+    if len(df) > LARGE_FIGURE_SIZE:
+        # one trace for all points, colored by day, instead of a trace per day
+        fig = go.Figure(go.Scattermapbox(lat=df.latitude.values, lon=df.longitude.values,
+                                         mode='markers',
+                                         marker=dict(color=df['day'].cat.codes.values, colorscale='Viridis'),
+                                         hovertext=df['datetime'].astype(str)))
+        fig.update_layout(mapbox=dict(accesstoken=MAPBOX_TOKEN, zoom=1))
+    else:
+        fig = px.scatter_mapbox(df, lat='latitude', lon='longitude',
+                                color="day", hover_name='datetime',
+                                category_orders={"day": list(df['day'].cat.categories)},
+                                hover_data=["latitude", "longitude"],
+                               zoom=1)
 
     fig.update_geos(projection_type="natural earth",
                 #projection_type="orthographic",
@@ -95,54 +200,70 @@ def create_figure(df: pd.DataFrame):
     fig.update(layout_coloraxis_showscale=False)
     return fig
 
-# set dataframe and figure
-df = get_df()
-fig = create_figure(df)
-
-
-app.layout = html.Div(children=[
-    html.H1(children='Photo Map Viewer', style={'textAlign': 'center'}),
-    html.Div(children='''
-        Uses extracted GPS info from photos to plot them on the map.
-        Click on any point to show the photo taken there!
-    ''', style={'textAlign': 'center'}),
-
-    dcc.Dropdown(
-        id='dropdown-map-region',
-        value='world',
-        options=[
-            {"label": "World", "value": "world"},
-            {"label": "Europe", "value": "europe"},
-            {"label": "United States", "value": "usa"},
-            {"label": "Rome, Italy", "value": "rome"},
-            {"label": "Pompeii, Italy", "value": "pompeii"},
-            {"label": "Florence, Italy", "value": "florence"},
-            {"label": "Antibes, France", "value": "antibes"},
-            {"label": "Mallorca, Spain", "value": "mallorca"},
-            {"label": "Barcelona, Spain", "value": "barcelona"},
-        ],
-        style={'width': '50%', 'margin-bottom':'10px',},
-    ),
-
-    html.Div(children=[
-        dcc.Graph(
-            id='Map',
-            figure=fig,
-            style={'display': 'inline-block',
-                  'height':'75vh',
-                  'width':'50%'}
-        ), 
-
-        html.Img(id="html-img", src='', 
-                 style={'height':'fit-content',
-                        'max-width':'calc(50% - 10px)',
-                        'max-height':'75vh',
-                       'display': 'inline-block',
-                        'border': 'black 10px solid',
-                       'margin':'auto',}),
-    ], style={'display':'flex'},)
-
-])
+
+def create_layout(fig) -> html.Div:
+    """Returns layout of the app with the map `fig`."""
+    return html.Div(children=[
+        html.H1(children='Photo Map Viewer', style={'textAlign': 'center'}),
+        html.Div(children='''
+            Uses extracted GPS info from photos to plot them on the map.
+            Click on any point to show the photo taken there!
+        ''', style={'textAlign': 'center'}),
+
+        dcc.Dropdown(
+            id='dropdown-map-region',
+            value='world',
+            options=[
+                {"label": "World", "value": "world"},
+                {"label": "Europe", "value": "europe"},
+                {"label": "United States", "value": "usa"},
+                {"label": "Rome, Italy", "value": "rome"},
+                {"label": "Pompeii, Italy", "value": "pompeii"},
+                {"label": "Florence, Italy", "value": "florence"},
+                {"label": "Antibes, France", "value": "antibes"},
+                {"label": "Mallorca, Spain", "value": "mallorca"},
+                {"label": "Barcelona, Spain", "value": "barcelona"},
+            ],
+            style={'width': '50%', 'margin-bottom':'10px',},
+        ),
+
+        html.Div(children=[
+            dcc.Graph(
+                id='Map',
+                figure=fig,
+                style={'display': 'inline-block',
+                      'height':'75vh',
+                      'width':'50%'}
+            ), 
+
+            html.Img(id="html-img", src='', 
+                     style={'height':'fit-content',
+                            'max-width':'calc(50% - 10px)',
+                            'max-height':'75vh',
+                           'display': 'inline-block',
+                            'border': 'black 10px solid',
+                           'margin':'auto',}),
+        ], style={'display':'flex'},)
+
+    ])
+
+
+# pool workers started by photos_util.construct_df re-import this module as '__mp_main__'
+# when processes are spawned instead of forked, so only the main process loads the photos and builds the app
+if __name__ != '__mp_main__':
+    MAPBOX_TOKEN = get_mapbox_token()
+    # set dataframe and figure
+    df = get_df()
+    fig = create_figure(df)
+    # name of the file served for each photo, its thumbnail if there is one,
+    # otherwise the photo itself unless it is heic which browsers can't display
+    df['served_name'] = df['thumbnail'].fillna(
+        df['filename'].where(~df['filename'].str.lower().str.endswith('.heic')))
+    # (datetime, latitude, longitude) -> served file name, used to find the photo of a clicked point
+    served_df = df.dropna(subset=['served_name'])
+    LOOKUP = dict(zip(zip(served_df['datetime'], served_df['latitude'], served_df['longitude']),
+                      served_df['served_name']))
+    app.layout = create_layout(fig)
 
 
 @app.callback(
@@ -151,18 +272,19 @@ app.layout = html.Div(children=[
 )
 def center_map_region(region):
     """Center the mapbox view on selected region"""
-    fig.update_mapboxes(center={'lat': regions[region]['lat'],
-                        'lon': regions[region]['lon']},
-                        zoom=regions[region]['zoom'])
-    return fig
+    # only send the changed layout values instead of the whole figure
+    patched_fig = Patch()
+    patched_fig['layout']['mapbox']['center'] = {'lat': regions[region]['lat'],
+                                                 'lon': regions[region]['lon']}
+    patched_fig['layout']['mapbox']['zoom'] = regions[region]['zoom']
+    return patched_fig
 
 
 @app.callback(
     Output("html-img", 'src'),
-    [Input('Map', 'clickData')],
-    [dash.State('Map', 'figure')]
+    [Input('Map', 'clickData')]
 )
-def show_html_img(clickData, fig):
+def show_html_img(clickData):
     """Show image of the data point when clicked on in the mapbox"""
     if clickData:
         point = clickData['points'][0]
@@ -170,10 +292,9 @@ def show_html_img(clickData, fig):
         p_lat = point['lat']
         p_lon = point['lon']
         
-        img_name = df[(df['datetime'] == p_datetime) & (df['latitude'] == p_lat) & (df['longitude'] == p_lon)]['filename'].values[0]
-        if img_name.endswith('.heic'):
-            # use converted image instead
-            img_name = img_name.replace('.heic', '.jpg')
+        img_name = LOOKUP.get((pd.Timestamp(p_datetime), p_lat, p_lon))
+        if img_name is None:
+            return ""
         return app.get_asset_url(img_name)
     else:
         return ""
@@ -9,8 +9,7 @@ Constructs DataFrame containing information about photos.
 import pandas as pd
 import numpy as np
 
-from PIL import Image, ExifTags
-from PIL.ExifTags import TAGS, GPSTAGS
+from PIL import Image, ImageOps, ExifTags
 import pillow_heif
 import base64
 pillow_heif.register_heif_opener()
@@ -19,6 +18,19 @@ pillow_heif.register_heif_opener()
 import os
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+# EXIF tag ids, see PIL.ExifTags.TAGS / GPSTAGS
+DATETIME = 0x0132
+GPS_IFD = 0x8825
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+
+# downsized copies of the photos are saved in this folder next to them, for displaying in the browser
+THUMBNAIL_DIR = 'thumbnails'
+THUMBNAIL_SIZE = (1600, 1600)
 
 
 def get_photos_from_path(directory_path: Path, extensions=['.jpg', '.jpeg', '.heic']) -> list:
@@ -30,91 +42,117 @@ def get_photos_from_path(directory_path: Path, extensions=['.jpg', '.jpeg', '.he
     if not os.path.exists(directory_path):
         print(f"{directory_path} is not a valid path.")
         return None
-    photos = [directory_path/p for p in os.listdir(directory_path) if Path(p).suffix.lower() in extensions]
+    exts = frozenset(e.lower() for e in extensions)
+    with os.scandir(directory_path) as entries:
+        photos = [Path(directory_path)/e.name for e in entries
+                  if e.is_file() and os.path.splitext(e.name)[1].lower() in exts]
     return photos
 
 
-def get_image(filepath: str):
-    """Returns Image from filepath"""
-    return Image.open(filepath)
-
-
-def get_exif(image):
-    """Returns EXIF data from image file"""
-    return image.getexif()
-
-
-def get_labeled_exif(exif):
-    """Returns dictionary of TAG names to the values from exif metadata"""
-    return {TAGS.get(key, key): value for key, value in exif.items()}
-
-
-def get_gps_info(exif):
-    """Returns dictionary of gps metadata from 'GPSInfo' tag in EXIF metadata"""
-    for key, value in TAGS.items():
-        if value == "GPSInfo":
-            gps_info = exif.get_ifd(key)
-            return {GPSTAGS.get(key, key): value for key, value in gps_info.items()}
-    return None
-    
-    
 #Credit: https://gist.github.com/pavelcherepan/49421ab64b78c5a9eee620789a5b44fa#file-coords-py
-def convert_coords_to_decimal(coords: tuple[float,...], ref: str) -> float:
-    """Covert a tuple of coordinates in the format (degrees, minutes, seconds)
-    and a reference to a decimal representation.
+def convert_coords_to_decimal(coords, refs) -> np.ndarray:
+    """Covert coordinates in the format (degrees, minutes, seconds)
+    and their references to a decimal representation, for all photos at once.
     Args:
-        coords (tuple[float,...]): A tuple of degrees, minutes and seconds
-        ref (str): Hemisphere reference of "N", "S", "E" or "W".
+        coords (array-like): An N x 3 array of degrees, minutes and seconds
+        refs (array-like): N hemisphere references of "N", "S", "E" or "W".
     Returns:
-        float: A signed float of decimal representation of the coordinate.
+        np.ndarray: Signed floats of decimal representation of the coordinates.
+            Coordinates with an incorrect reference are NaN.
     """
-    if ref.upper() in ['W', 'S']:
-        mul = -1
-    elif ref.upper() in ['E', 'N']:
-        mul = 1
-    else:
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    refs = np.char.upper(np.asarray(refs, dtype=str))
+    mul = np.select([np.isin(refs, ['W', 'S']), np.isin(refs, ['E', 'N'])], [-1.0, 1.0], default=np.nan)
+    if np.isnan(mul).any():
         print("Incorrect hemisphere reference. "
               "Expecting one of 'N', 'S', 'E' or 'W', "
-              f'got {ref} instead.')
-    # make sure coords are made of floats
-    coords = [float(i) for i in coords]
+              f'got {sorted(set(refs[np.isnan(mul)].tolist()))} instead.')
         
-    return mul * (coords[0] + coords[1] / 60 + coords[2] / 3600)  
+    return mul * (coords[:, 0] + coords[:, 1] / 60 + coords[:, 2] / 3600)
+
+
+def parse_exif_datetime(date_str: str) -> datetime:
+    """Returns datetime from an EXIF date string in the format 'YYYY:MM:DD HH:MM:SS'.
+    Slices the fixed positions directly, falling back to strptime for other layouts."""
+    try:
+        return datetime(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]),
+                        int(date_str[11:13]), int(date_str[14:16]), int(date_str[17:19]))
+    except ValueError:
+        return datetime.strptime(date_str, '%Y:%m:%d %H:%M:%S')
+
+
+def save_thumbnail(photo: Path) -> str:
+    """Saves a downsized jpg copy of `photo` in the thumbnail folder next to it, used for displaying
+    it in the browser (also for heic photos, which browsers can't display).
+    Skipped if the thumbnail is already newer than `photo`.
+    Returns path of the thumbnail relative to the folder of `photo`.
+    """
+    thumbnail_path = photo.parent/THUMBNAIL_DIR/(photo.name + '.jpg')
+    if not os.path.exists(thumbnail_path) or os.path.getmtime(thumbnail_path) < os.path.getmtime(photo):
+        os.makedirs(thumbnail_path.parent, exist_ok=True)
+        with Image.open(photo) as img:
+            img.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+            # thumbnail has no EXIF data, so apply its orientation to the pixels
+            img = ImageOps.exif_transpose(img)
+            img.convert('RGB').save(thumbnail_path, quality=80, optimize=True, progressive=True)
+    return f"{THUMBNAIL_DIR}/{thumbnail_path.name}"
+
+
+def _extract_photo_record(photo: Path) -> dict | None:
+    """Returns dictionary of photo info read from the EXIF metadata of `photo`.
+    Returns None if the photo could not be read or is missing GPS/date info.
+    
+    Also saves a thumbnail of the photo for displaying it.
+    """
+    try:
+        # only the EXIF header is read here, so photos without GPS/date info are skipped
+        # before their pixel data is decoded for the thumbnail
+        with Image.open(photo) as img:
+            img_exif = img.getexif()
+            img_gps = img_exif.get_ifd(GPS_IFD)
+            date_str = img_exif[DATETIME]
+        # raw (degrees, minutes, seconds), converted to decimal for all photos in construct_df
+        latitude = tuple(float(i) for i in img_gps[GPS_LATITUDE])
+        longitude = tuple(float(i) for i in img_gps[GPS_LONGITUDE])
+        latitude_ref = img_gps[GPS_LATITUDE_REF]
+        longitude_ref = img_gps[GPS_LONGITUDE_REF]
+        date = parse_exif_datetime(date_str)
+    except (KeyError, OSError, ValueError):
+        # skip photos that could not be added
+        return None
+    try:
+        thumbnail = save_thumbnail(photo)
+    except OSError as e:
+        print(f"Could not save thumbnail of {photo}: {e}")
+        thumbnail = None
+    return {
+        'filename': Path(photo).name,
+        'datetime': date,
+        'latitude': latitude,
+        'longitude': longitude,
+        'day': date.day,
+        'latitude_ref': latitude_ref,
+        'longitude_ref': longitude_ref,
+        'thumbnail': thumbnail,
+    }
 
 
 def construct_df(photos: list) -> pd.DataFrame:
     """Returns DataFrame using a list of photo filepaths (jpg, jpeg, or heic only).
-    Columns: filename, datetime, latitude, longitude, day"""
-    df=pd.DataFrame()
-    i=0
-    for photo in photos:
-        if photo.suffix.lower() not in ['.jpg', '.jpeg', '.heic']:
-            # skip non-jpg files
-            continue
-        img = get_image(photo)
-        img_exif = get_exif(img)
-        img_tags = get_labeled_exif(img_exif)
-        img_gps = get_gps_info(img_exif)
-        try:
-            latitude = convert_coords_to_decimal(img_gps['GPSLatitude'], img_gps['GPSLatitudeRef'])
-            longitude = convert_coords_to_decimal(img_gps['GPSLongitude'], img_gps['GPSLongitudeRef'])
-            date = datetime.strptime(img_tags['DateTime'], '%Y:%m:%d %H:%M:%S')
-            d = {
-                'filename': Path(photo).name,
-                'datetime': date,
-                # 'gps_latitude': img_gps['GPSLatitude'],
-                # 'gps_longitude': img_gps['GPSLongitude'],
-                # 'gps_latitude_ref': img_gps['GPSLatitudeRef'],
-                # 'gps_longitude_ref': img_gps['GPSLongitudeRef']
-                'latitude': latitude,
-                'longitude': longitude,
-                'day': date.day
-            }
-        except KeyError:
-            # skip photos that could not be added
-            continue
-        #df = df.append(d, ignore_index=True)
-        df = pd.concat([df, pd.DataFrame(d, index=[i])])
-        i+=1
-    print("Number of photos added vs total:", i, len(photos)) # number that went through 
-    return df
\ No newline at end of file
+    Columns: filename, datetime, latitude, longitude, day, thumbnail
+    
+    `photos` is expected to already be filtered by extension, e.g. by get_photos_from_path.
+    
+    EXIF metadata is read in parallel across worker processes.
+    """
+    with ProcessPoolExecutor() as executor:
+        records = [r for r in executor.map(_extract_photo_record, photos, chunksize=16) if r is not None]
+    # build DataFrame once instead of concatenating per photo
+    df = pd.DataFrame.from_records(records, columns=['filename', 'datetime', 'latitude', 'longitude', 'day',
+                                                     'thumbnail', 'latitude_ref', 'longitude_ref'])
+    df['latitude'] = convert_coords_to_decimal(df['latitude'].tolist(), df.pop('latitude_ref'))
+    df['longitude'] = convert_coords_to_decimal(df['longitude'].tolist(), df.pop('longitude_ref'))
+    # skip photos whose coordinates could not be converted
+    df = df.dropna(subset=['latitude', 'longitude']).reset_index(drop=True)
+    print("Number of photos added vs total:", len(df), len(photos)) # number that went through 
+    return df